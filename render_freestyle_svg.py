@@ -32,14 +32,16 @@ bl_info = {
 
 import bpy
 import parameter_editor
+import io
 import itertools
 import os
+import numpy as np
 
 import xml.etree.cElementTree as et
 
 from bpy.app.handlers import persistent
-from collections import OrderedDict
-from functools import partial
+from collections import OrderedDict, deque
+from functools import lru_cache, partial
 from mathutils import Vector
 
 from freestyle.types import (
@@ -52,7 +54,6 @@ from freestyle.types import (
 from freestyle.utils import (
     getCurrentScene,
     BoundingBox,
-    is_poly_clockwise,
     StrokeCollector,
     material_from_fedge,
     get_object_name,
@@ -85,12 +86,13 @@ from parameter_editor import get_dashed_pattern
 from bpy.props import (
         BoolProperty,
         EnumProperty,
+        IntProperty,
         PointerProperty,
         )
 
 
-# use utf-8 here to keep ElementTree happy, end result is utf-16
-svg_primitive = """<?xml version="1.0" encoding="ascii" standalone="no"?>
+# the header is parsed as utf-8, the same encoding ElementTree uses to write the final file
+svg_primitive = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
 <!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN"
   "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
 <svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{:d}" height="{:d}">
@@ -106,13 +108,13 @@ namespaces = {
     }
 
 
-# wrap XMLElem.find, so the namespaces don't need to be given as an argument
-def find_xml_elem(obj, search, namespaces, *, all=False):
-    if all:
-        return obj.findall(search, namespaces=namespaces)
-    return obj.find(search, namespaces=namespaces)
-
-find_svg_elem = partial(find_xml_elem, namespaces=namespaces)
+# qualified names of the elements and attributes, as ElementTree stores them.
+# Elements created in memory must use these too, to match those of a parsed file.
+SVG_G = "{{{}}}g".format(namespaces["svg"])
+SVG_PATH = "{{{}}}path".format(namespaces["svg"])
+SVG_ANIMATE = "{{{}}}animate".format(namespaces["svg"])
+INKSCAPE_GROUPMODE = "{{{}}}groupmode".format(namespaces["inkscape"])
+INKSCAPE_LABEL = "{{{}}}label".format(namespaces["inkscape"])
 
 
 def render_height(scene):
@@ -127,6 +129,68 @@ def format_rgb(color):
     return 'rgb({}, {}, {})'.format(*(int(v * 255) for v in color))
 
 
+def stroke_coordinates(stroke):
+    """Returns the coordinates of the stroke's vertices (or a sequence of
+    stroke vertices) as a (n, 2) array"""
+    coords = itertools.chain.from_iterable(svert.point for svert in stroke)
+    return np.fromiter(coords, dtype=np.float64, count=2 * len(stroke)).reshape(-1, 2)
+
+
+def stroke_points(stroke, height):
+    """Returns the SVG coordinates of the stroke's vertices (or a sequence of
+    stroke vertices) as a (n, 2) array"""
+    points = stroke_coordinates(stroke)
+    # SVG's y-axis points down: flip all y-coordinates in place
+    ys = points[:, 1]
+    np.subtract(height, ys, out=ys)
+    return points
+
+
+def svg_points(coordinates, height):
+    """Returns the SVG coordinates of a (n, 2) array of coordinates, as a new array"""
+    points = coordinates.copy()
+    ys = points[:, 1]
+    np.subtract(height, ys, out=ys)
+    return points
+
+
+def format_points(points, precision):
+    """Formats a (n, 2) array of points as SVG path data, with the given number of decimals"""
+    # format every coordinate in a single call
+    point_format = "%.{0}f,%.{0}f".format(precision)
+    return " ".join([point_format] * len(points)) % tuple(points.ravel().tolist())
+
+
+def points_bounding_box(points):
+    """Returns the BoundingBox of a (n, 2) array of points"""
+    return BoundingBox(Vector(points.min(axis=0).tolist()), Vector(points.max(axis=0).tolist()))
+
+
+def is_points_clockwise(points):
+    """Returns whether the polygon of a (n, 2) array of points is clockwise,
+    computed the same way as freestyle.utils.is_poly_clockwise"""
+    if len(points) < 2:
+        return False
+    xs, ys = points[:, 0], points[:, 1]
+    v = np.dot(xs[1:] - xs[:-1], ys[:-1] + ys[1:])
+    (x1, y1), (x2, y2) = points[0], points[-1]
+    if np.hypot(x1 - x2, y1 - y2) > 1e-3:
+        v += (x2 - x1) * (y1 + y2)
+    return bool(v > 0)
+
+
+def split_at_invisible_vertices(points, visible):
+    """Splits a (n, 2) array of points into runs of visible vertices.
+    Every run is closed by the first invisible vertex that follows it."""
+    invisible = np.flatnonzero(~visible)
+    if not len(invisible):
+        return [points]
+    # a run starts at the first vertex and at every visible vertex preceded by an invisible one
+    starts = np.flatnonzero(np.concatenate(([True], ~visible[:-1] & visible[1:])))
+    ends = np.append(invisible + 1, len(points))[np.searchsorted(invisible, starts)]
+    return [points[start:end] for start, end in zip(starts, ends)]
+
+
 # stores the state of the render, used to differ between animation and single frame renders.
 class RenderState:
 
@@ -135,9 +199,72 @@ class RenderState:
     is_preview = True
 
 
+# parsed SVG documents that are being exported, keyed by filepath. All shaders modify the
+# same tree in memory. It is written to file once per frame, or, when an animation is
+# rendered, only once when the render is complete.
+_svg_trees = {}
+
+
+def parse_svg(source):
+    """Parses an SVG file (or file object), indexing its lineset groups by id"""
+    tree = et.parse(source)
+    tree._lineset_groups = {
+        g.get('id'): g for g in tree.getroot()
+        if g.tag == SVG_G and g.get(INKSCAPE_GROUPMODE) == 'lineset'
+        }
+    return tree
+
+
+def get_svg_tree(filepath):
+    """Returns the SVG tree of the given file, it is parsed only when not in memory yet"""
+    tree = _svg_trees.get(filepath)
+    if tree is None:
+        tree = _svg_trees[filepath] = parse_svg(filepath)
+    return tree
+
+
+def write_svg(tree, filepath, pretty=False):
+    """Writes an SVG tree to file"""
+    print("SVG Export: writing to", filepath)
+    if pretty:
+        indent_xml(tree.getroot())
+    tree.write(filepath, encoding='UTF-8', xml_declaration=True)
+
+
+def write_svg_trees(scene):
+    """Writes all SVG trees in memory to file"""
+    while _svg_trees:
+        filepath, tree = _svg_trees.popitem()
+        write_svg(tree, filepath, scene.svg_export.pretty_svg)
+
+
+def get_lineset_group(tree, name):
+    """Returns the <g> of the given lineset, it is created when the tree has none yet"""
+    lineset_group = tree._lineset_groups.get(name)
+    if lineset_group is None:
+        lineset_group = et.SubElement(tree.getroot(), SVG_G, {
+            'id': name,
+            INKSCAPE_GROUPMODE: 'lineset',
+            INKSCAPE_LABEL: name,
+            })
+        tree._lineset_groups[name] = lineset_group
+    return lineset_group
+
+
+def get_frame_group(lineset_group, frame):
+    """Returns the <g> of the given frame in a lineset, it is created when the lineset has none yet"""
+    id = "frame_{:04n}".format(frame)
+    # the current frame is the last one added to the lineset
+    if len(lineset_group) and lineset_group[-1].get('id') == id:
+        return lineset_group[-1]
+    return et.SubElement(lineset_group, SVG_G, {'id': id, INKSCAPE_GROUPMODE: 'frame', INKSCAPE_LABEL: id})
+
+
 @persistent
 def render_init(scene):
     RenderState.is_preview = True
+    _svg_trees.clear()
+    _path_cache.clear()
 
 
 @persistent
@@ -149,15 +276,23 @@ def is_preview_render(scene):
     return RenderState.is_preview or scene.svg_export.mode == 'FRAME'
 
 
+# output paths of the current render, keyed by (scene pointer, frame)
+_path_cache = {}
+
+
 def create_path(scene):
     """Creates the output path for the svg file"""
-    dirname = os.path.dirname(scene.render.frame_path())
-    basename = bpy.path.basename(scene.render.filepath)
-    if scene.svg_export.mode == 'FRAME':
-        frame = "{:04d}".format(scene.frame_current)
-    else:
-        frame = "{:04d}-{:04d}".format(scene.frame_start, scene.frame_end)
-    return os.path.join(dirname, basename + frame + ".svg")
+    key = (scene.as_pointer(), scene.frame_current)
+    filepath = _path_cache.get(key)
+    if filepath is None:
+        dirname = os.path.dirname(scene.render.frame_path())
+        basename = bpy.path.basename(scene.render.filepath)
+        if scene.svg_export.mode == 'FRAME':
+            frame = "{:04d}".format(scene.frame_current)
+        else:
+            frame = "{:04d}-{:04d}".format(scene.frame_start, scene.frame_end)
+        filepath = _path_cache[key] = os.path.join(dirname, basename + frame + ".svg")
+    return filepath
 
 
 class SVGExporterLinesetPanel(bpy.types.Panel):
@@ -205,6 +340,16 @@ class SVGExport(bpy.types.PropertyGroup):
             name="Fill Contours",
             description="Fill the contour with the object's material color",
             )
+    pretty_svg = BoolProperty(
+            name="Pretty Print",
+            description="Indent the SVG output, this takes longer for scenes with many strokes",
+            )
+    coord_precision = IntProperty(
+            name="Precision",
+            description="Number of decimals of the exported coordinates",
+            min=0, max=6,
+            default=3,
+            )
     mode = EnumProperty(
             name="Mode",
             items=(
@@ -251,6 +396,10 @@ class SVGExporterPanel(bpy.types.Panel):
         row.prop(svg, "split_at_invisible")
         row.prop(svg, "object_fill")
 
+        row = layout.row()
+        row.prop(svg, "pretty_svg")
+        row.prop(svg, "coord_precision")
+
         row = layout.row()
         row.prop(svg, "line_join_type", expand=True)
 
@@ -264,9 +413,24 @@ def svg_export_header(scene):
     if not is_preview_render(scene) and scene.frame_current != scene.frame_start:
         return
 
-    # this may fail still. The error is printed to the console.
-    with open(create_path(scene), "w") as f:
-        f.write(svg_primitive.format(render_width(scene), render_height(scene)))
+    # the header only seeds the tree in memory, the file is written when the frame
+    # (or animation) is complete. Errors while writing are printed to the console.
+    header = svg_primitive.format(render_width(scene), render_height(scene)).encode("utf-8")
+    _svg_trees[create_path(scene)] = parse_svg(io.BytesIO(header))
+
+
+@persistent
+def svg_export_frame(scene):
+    """Writes the SVG trees modified while rendering the current frame to file"""
+    # an animation is kept in memory and written once, by svg_export_animation
+    if is_preview_render(scene):
+        write_svg_trees(scene)
+
+
+@persistent
+def svg_export_cancel(scene):
+    """Writes the frames rendered so far when a render is cancelled"""
+    write_svg_trees(scene)
 
 
 @persistent
@@ -276,57 +440,83 @@ def svg_export_animation(scene):
     svg = scene.svg_export
 
     if render.use_freestyle and svg.use_svg_export and not is_preview_render(scene):
-        write_animation(create_path(scene), scene.frame_start, render.fps)
+        write_animation(create_path(scene), scene.frame_start, render.fps, pretty=svg.pretty_svg)
 
 
-def write_animation(filepath, frame_begin, fps):
-    """Adds animate tags to the specified file."""
-    tree = et.parse(filepath)
-    root = tree.getroot()
+@lru_cache(maxsize=32)
+def animation_key_times(n_of_frames):
+    """Returns the keyTimes of an animation with the given number of frames"""
+    return ";".join(str(round(x / n_of_frames, 3)) for x in range(n_of_frames)) + ";1"
+
 
-    linesets = find_svg_elem(tree, ".//svg:g[@inkscape:groupmode='lineset']", all=True)
-    for i, lineset in enumerate(linesets):
-        name = lineset.get('id')
-        frames = find_svg_elem(lineset, ".//svg:g[@inkscape:groupmode='frame']", all=True)
+@lru_cache(maxsize=32)
+def animation_values(n_of_frames):
+    """Returns the display values of an animation with the given number of frames"""
+    return "none;" * (n_of_frames - 1) + "inline;none"
+
+
+def write_animation(filepath, frame_begin, fps, *, pretty=False):
+    """Adds animate tags to the specified file."""
+    tree = _svg_trees.pop(filepath, None)
+    if tree is None:
+        tree = parse_svg(filepath)
+
+    # the animation style only depends on the number of frames, which is
+    # usually the same for all linesets: build it once per frame count
+    styles = {}
+
+    # the frames are children of the (indexed) lineset groups, only those are visited,
+    # not the paths nested in them
+    for lineset in tree._lineset_groups.values():
+        frames = [g for g in lineset if g.get(INKSCAPE_GROUPMODE) == 'frame']
         n_of_frames = len(frames)
-        keyTimes = ";".join(str(round(x / n_of_frames, 3)) for x in range(n_of_frames)) + ";1"
-
-        style = {
-            'attributeName': 'display',
-            'values': "none;" * (n_of_frames - 1) + "inline;none",
-            'repeatCount': 'indefinite',
-            'keyTimes': keyTimes,
-            'dur': "{:.3f}s".format(n_of_frames / fps),
-            }
 
+        style = styles.get(n_of_frames)
+        if style is None:
+            style = styles[n_of_frames] = {
+                'attributeName': 'display',
+                'values': animation_values(n_of_frames),
+                'repeatCount': 'indefinite',
+                'keyTimes': animation_key_times(n_of_frames),
+                'dur': "{:.3f}s".format(n_of_frames / fps),
+                }
+
+        id_prefix = 'anim_{}_'.format(lineset.get('id'))
         for j, frame in enumerate(frames):
-            id = 'anim_{}_{:06n}'.format(name, j + frame_begin)
-            # create animate tag
-            frame_anim = et.XML('<animate id="{}" begin="{:.3f}s" />'.format(id, (j - n_of_frames) / fps))
-            # add per-lineset style attributes
-            frame_anim.attrib.update(style)
-            # add to the current frame
-            frame.append(frame_anim)
+            id = id_prefix + '{:06n}'.format(j + frame_begin)
+            begin = "{:.3f}s".format((j - n_of_frames) / fps)
+            # add an animate tag with the per-lineset style attributes to the current frame
+            et.SubElement(frame, SVG_ANIMATE, style, id=id, begin=begin)
 
     # write SVG to file
-    indent_xml(root)
-    tree.write(filepath, encoding='ascii', xml_declaration=True)
+    write_svg(tree, filepath, pretty)
 
 
 # - StrokeShaders - #
+
+# path style attributes, keyed by the linestyle and scene properties they are built from
+_style_cache = {}
+
+
 class SVGPathShader(StrokeShader):
     """Stroke Shader for writing stroke data to a .svg file."""
-    def __init__(self, name, style, filepath, res_y, split_at_invisible, stroke_color_mode, frame_current):
+    def __init__(self, name, style, filepath, res_y, split_at_invisible, stroke_color_mode, frame_current, precision):
         StrokeShader.__init__(self)
         # attribute 'name' of 'StrokeShader' objects is not writable, so _name is used
         self._name = name
         self.filepath = filepath
         self.h = res_y
         self.frame_current = frame_current
-        self.elements = []
+        # path data of the strokes, as (color, path data) runs of consecutive strokes of the same color
+        self.paths = deque()
         self.split_at_invisible = split_at_invisible
         self.stroke_color_mode = stroke_color_mode # BASE | FIRST | LAST
+        self.precision = precision
+        # the style is shared between shaders of the same linestyle, it is never modified
         self.style = style
+        # the path parameters are fixed for the lifetime of the shader
+        self.stroke_to_paths = partial(self.pathgen, height=res_y, split_at_invisible=split_at_invisible,
+                                       precision=precision)
 
 
     @classmethod
@@ -336,233 +526,250 @@ class SVGPathShader(StrokeShader):
         linestyle = lineset.linestyle
         # extract style attributes from the linestyle and scene
         svg = getCurrentScene().svg_export
-        style = {
-            'fill': 'none',
-            'stroke-width': linestyle.thickness,
-            'stroke-linecap': linestyle.caps.lower(),
-            'stroke-opacity': linestyle.alpha,
-            'stroke': format_rgb(linestyle.color),
-            'stroke-linejoin': svg.line_join_type.lower(),
-            }
-        # get dashed line pattern (if specified)
-        if linestyle.use_dashed_line:
-            style['stroke-dasharray'] = ",".join(str(elem) for elem in get_dashed_pattern(linestyle))
+        dashes = tuple(get_dashed_pattern(linestyle)) if linestyle.use_dashed_line else ()
+        key = (linestyle.thickness, linestyle.caps, linestyle.alpha, tuple(linestyle.color),
+               svg.line_join_type, dashes)
+        style = _style_cache.get(key)
+        if style is None:
+            thickness, caps, alpha, color, line_join_type, dashes = key
+            # ElementTree only serializes string attribute values
+            style = {
+                'fill': 'none',
+                'stroke-width': str(thickness),
+                'stroke-linecap': caps.lower(),
+                'stroke-opacity': str(alpha),
+                'stroke': format_rgb(color),
+                'stroke-linejoin': line_join_type.lower(),
+                }
+            # add dashed line pattern (if specified)
+            if dashes:
+                style['stroke-dasharray'] = ",".join(str(elem) for elem in dashes)
+            _style_cache[key] = style
         # return instance
-        return cls(name, style, filepath, res_y, split_at_invisible, use_stroke_color, frame_current)
+        return cls(name, style, filepath, res_y, split_at_invisible, use_stroke_color, frame_current,
+                   svg.coord_precision)
 
 
     @staticmethod
-    def pathgen(stroke, style, height, split_at_invisible, stroke_color_mode, f=lambda v: not v.attribute.visible):
-        """Generator that creates SVG paths (as strings) from the current stroke """
+    def pathgen(stroke, height, split_at_invisible, precision):
+        """Generator that creates SVG path data (the 'd' attribute) from the current stroke """
         if len(stroke) <= 1:
             return ""
 
-        if stroke_color_mode != 'BASE':
+        # iterate the stroke only once, both the points and the visibility are read from this
+        svertices = tuple(stroke)
+        points = stroke_points(svertices, height)
+        if split_at_invisible:
+            visible = np.fromiter((svert.attribute.visible for svert in svertices), dtype=bool, count=len(svertices))
+            segments = split_at_invisible_vertices(points, visible)
+        else:
+            segments = (points,)
+
+        for segment in segments:
+            yield 'M ' + format_points(segment, precision)
+
+    def stroke_color(self, stroke):
+        """Returns the color of the stroke's path(s)"""
+        if self.stroke_color_mode != 'BASE':
             # try to use the color of the first or last vertex
             try:
-                index = 0 if stroke_color_mode == 'FIRST' else -1
-                color = format_rgb(stroke[index].attribute.color)
-                style["stroke"] = color
+                index = 0 if self.stroke_color_mode == 'FIRST' else -1
+                return format_rgb(stroke[index].attribute.color)
             except (ValueError, IndexError):
                 # default is linestyle base color
                 pass
-
-        # put style attributes into a single svg path definition
-        path = '\n<path ' + "".join('{}="{}" '.format(k, v) for k, v in style.items()) + 'd=" M '
-
-        it = iter(stroke)
-        # start first path
-        yield path
-        for v in it:
-            x, y = v.point
-            yield '{:.3f}, {:.3f} '.format(x, height - y)
-            if split_at_invisible and v.attribute.visible is False:
-                # end current and start new path;
-                yield '" />' + path
-                # fast-forward till the next visible vertex
-                it = itertools.dropwhile(f, it)
-                # yield next visible vertex
-                svert = next(it, None)
-                if svert is None:
-                    break
-                x, y = svert.point
-                yield '{:.3f}, {:.3f} '.format(x, height - y)
-        # close current path
-        yield '" />'
+        return self.style['stroke']
 
     def shade(self, stroke):
-        stroke_to_paths = "".join(self.pathgen(stroke, self.style, self.h, self.split_at_invisible, self.stroke_color_mode)).split("\n")
-        # convert to actual XML. Empty strokes are empty strings; they are ignored.
-        self.elements.extend(et.XML(elem) for elem in stroke_to_paths if elem) # if len(elem.strip()) > len(self.path))
+        # consecutive strokes of the same color end up in a single path, every stroke (and every
+        # part of a stroke split at an invisible vertex) starts a new subpath with its own 'M'.
+        # A change of color starts a new path, so overlapping strokes keep their paint order.
+        paths = tuple(self.stroke_to_paths(stroke))
+        if not paths:
+            return
+        color = self.stroke_color(stroke)
+        if not self.paths or self.paths[-1][0] != color:
+            self.paths.append((color, []))
+        self.paths[-1][1].extend(paths)
 
     def write(self):
-        """Write SVG data tree to file """
-        tree = et.parse(self.filepath)
-        root = tree.getroot()
+        """Adds the strokes to the SVG data tree of the current frame """
+        tree = get_svg_tree(self.filepath)
         name = self._name
         scene = bpy.context.scene
 
         # create <g> for lineset as a whole (don't overwrite)
         # when rendering an animation, frames will be nested in here, otherwise a group of strokes and optionally fills.
-        lineset_group = find_svg_elem(tree, ".//svg:g[@id='{}']".format(name))
-        if lineset_group is None:
-            lineset_group = et.XML('<g/>')
-            lineset_group.attrib = {
-                'id': name,
-                'xmlns:inkscape': namespaces["inkscape"],
-                'inkscape:groupmode': 'lineset',
-                'inkscape:label': name,
-                }
-            root.append(lineset_group)
+        lineset_group = get_lineset_group(tree, name)
 
         # create <g> for the current frame
-        id = "frame_{:04n}".format(self.frame_current)
-
-        stroke_group = et.XML("<g/>")
-        stroke_group.attrib = {
-            'xmlns:inkscape': namespaces["inkscape"],
-            'inkscape:groupmode': 'layer',
-            'id': 'strokes',
-            'inkscape:label': 'strokes'
-            }
-        # nest the structure
-        stroke_group.extend(self.elements)
         if scene.svg_export.mode == 'ANIMATION':
-            frame_group = et.XML("<g/>")
-            frame_group.attrib = {'id': id, 'inkscape:groupmode': 'frame', 'inkscape:label': id}
-            frame_group.append(stroke_group)
-            lineset_group.append(frame_group)
+            parent = get_frame_group(lineset_group, self.frame_current)
         else:
-            lineset_group.append(stroke_group)
+            parent = lineset_group
 
-        # write SVG to file
-        print("SVG Export: writing to", self.filepath)
-        indent_xml(root)
-        tree.write(self.filepath, encoding='ascii', xml_declaration=True)
+        # nest the structure, every element is created directly inside its parent.
+        # The style is set on the group once, the paths inherit it.
+        stroke_group = et.SubElement(parent, SVG_G, {
+            INKSCAPE_GROUPMODE: 'layer',
+            'id': 'strokes',
+            INKSCAPE_LABEL: 'strokes'
+            })
+        stroke_group.attrib.update(self.style)
+        # The path data is released as soon as it has been joined,
+        # so at most one copy of it is alive.
+        while self.paths:
+            color, paths = self.paths.popleft()
+            path = et.SubElement(stroke_group, SVG_PATH, d=" ".join(paths))
+            # only paths with a vertex color override the group's stroke color
+            if color != self.style['stroke']:
+                path.set('stroke', color)
+
+
+class InvisibleStrokeShader(StrokeShader):
+    """Stroke Shader that makes all vertices of a stroke invisible."""
+    def shade(self, stroke):
+        for svert in stroke:
+            svert.attribute.visible = False
+
+
+# fill style attributes, keyed by the diffuse color they are built from
+_fill_style_cache = {}
+
+
+def fill_style(diffuse):
+    """Returns the style attributes of a fill with the given diffuse color"""
+    diffuse = tuple(diffuse)
+    style = _fill_style_cache.get(diffuse)
+    if style is None:
+        *color, alpha = diffuse
+        style = _fill_style_cache[diffuse] = {
+            'fill-rule': 'evenodd',
+            'stroke': 'none',
+            'fill-opacity': str(alpha),
+            'fill': format_rgb(color),
+            }
+    return style
 
 
 class SVGFillBuilder:
-    def __init__(self, filepath, height, name):
+    def __init__(self, filepath, height, name, precision):
         self.filepath = filepath
         self._name = name
+        self.height = height
+        self.precision = precision
         self.stroke_to_fill = partial(self.stroke_to_svg, height=height)
 
     @staticmethod
-    def pathgen(vertices, path, height):
-        yield path
-        for point in vertices:
-            x, y = point
-            yield '{:.3f}, {:.3f} '.format(x, height - y)
-        yield ' z" />'  # closes the path; connects the current to the first point
+    def pathgen(points, precision):
+        # the trailing 'z' closes the path; connects the current to the first point
+        return 'M ' + format_points(points, precision) + ' z'
 
 
     @staticmethod
-    def get_merged_strokes(strokes):
+    def get_merged_strokes(strokes, diffuses=None, coordinates=None):
         def extend_stroke(stroke, vertices):
             for vert in map(StrokeVertex, vertices):
                 stroke.insert_vertex(vert, stroke.stroke_vertices_end())
             return stroke
 
-        base_strokes = tuple(stroke for stroke in strokes if not is_poly_clockwise(stroke))
+        # the bounding box, diffuse color and winding of every stroke are computed only once,
+        # the box and winding from a single read of the stroke's coordinates
+        if coordinates is None:
+            coordinates = {stroke: stroke_coordinates(stroke) for stroke in strokes}
+        boxes = {stroke: points_bounding_box(coordinates[stroke]) for stroke in strokes}
+        clockwise = {stroke: is_points_clockwise(coordinates[stroke]) for stroke in strokes}
+        if diffuses is None:
+            diffuses = {stroke: diffuse_from_stroke(stroke) for stroke in strokes}
+
+        base_strokes = tuple(stroke for stroke in strokes if not clockwise[stroke])
         merged_strokes = OrderedDict((s, list()) for s in base_strokes)
+        # strokes that are inside a base of another color, by that base
+        covered = {}
 
-        for stroke in filter(is_poly_clockwise, strokes):
+        for stroke in filter(clockwise.get, strokes):
+            inside = None
             for base in base_strokes:
                 # don't merge when diffuse colors don't match
-                if diffuse_from_stroke(stroke) != diffuse_from_stroke(stroke):
+                if diffuses[stroke] != diffuses[base]:
+                    if inside is None and boxes[stroke].inside(boxes[base]):
+                        inside = base
                     continue
                 # only merge when the 'hole' is inside the base
-                elif stroke_inside_stroke(stroke, base):
+                elif boxes[stroke].inside(boxes[base]):
                     merged_strokes[base].append(stroke)
                     break
                 # if it isn't a hole, it is likely that there are two strokes belonging
                 # to the same object separated by another object. let's try to join them
-                elif (get_object_name(base) == get_object_name(stroke) and 
-                      diffuse_from_stroke(stroke) == diffuse_from_stroke(stroke)):
+                elif get_object_name(base) == get_object_name(stroke):
                     base = extend_stroke(base, (sv for sv in stroke))
+                    # the base has grown, and so have its coordinates and bounding box
+                    coordinates[base] = np.concatenate((coordinates[base], coordinates[stroke]))
+                    boxes[base] = points_bounding_box(coordinates[base])
                     break
             else:
                 # if all else fails, treat this stroke as a base stroke
-                merged_strokes.update({stroke:  []})
-        return merged_strokes
-
-
-    def stroke_to_svg(self, stroke, height, parameters=None):
+                if inside is None:
+                    merged_strokes[stroke] = []
+                else:
+                    covered.setdefault(inside, []).append(stroke)
+
+        if not covered:
+            return merged_strokes
+        # a stroke inside a base of another color has to be painted over that base. The fills are
+        # painted in reverse order, so it is placed right before the base.
+        ordered_strokes = OrderedDict()
+        for base, holes in merged_strokes.items():
+            for stroke in covered.get(base, ()):
+                ordered_strokes[stroke] = []
+            ordered_strokes[base] = holes
+        return ordered_strokes
+
+
+    def stroke_to_svg(self, stroke, height, parameters=None, coordinates=None):
         if parameters is None:
-            *color, alpha = diffuse_from_stroke(stroke)
-            color = tuple(int(255 * c) for c in color)
-            parameters = {
-                'fill_rule': 'evenodd',
-                'stroke': 'none',
-                'fill-opacity': alpha,
-                'fill': 'rgb' + repr(color),
-            }
-        param_str = " ".join('{}="{}"'.format(k, v) for k, v in parameters.items())
-        path = '<path {} d=" M '.format(param_str)
-        vertices = (svert.point for svert in stroke)
-        s = "".join(self.pathgen(vertices, path, height))
-        result = et.XML(s)
-        return result
+            parameters = fill_style(diffuse_from_stroke(stroke))
+        if coordinates is None:
+            points = stroke_points(stroke, height)
+        else:
+            points = svg_points(coordinates, height)
+        return et.Element(SVG_PATH, parameters, d=self.pathgen(points, self.precision))
 
     def create_fill_elements(self, strokes):
         """Creates ElementTree objects by merging stroke objects together and turning them into SVG paths."""
-        merged_strokes = self.get_merged_strokes(strokes)
+        # the coordinates and diffuse color of every stroke are looked up once,
+        # they are shared by the merging and the path data and style of the fills
+        coordinates = {stroke: stroke_coordinates(stroke) for stroke in strokes}
+        diffuses = {stroke: diffuse_from_stroke(stroke) for stroke in strokes}
+        merged_strokes = self.get_merged_strokes(strokes, diffuses, coordinates)
         for k, v in merged_strokes.items():
-            base = self.stroke_to_fill(k)
-            fills = (self.stroke_to_fill(stroke).get("d") for stroke in v)
-            merged_points = " ".join(fills)
-            base.attrib['d'] += merged_points
-            yield base 
+            base = self.stroke_to_fill(k, parameters=fill_style(diffuses[k]), coordinates=coordinates[k])
+            # the holes only add their path data to the base, no elements are created for them
+            fills = (self.pathgen(svg_points(coordinates[stroke], self.height), self.precision) for stroke in v)
+            base.set('d', " ".join(itertools.chain((base.get('d'),), fills)))
+            yield base
 
     def write(self, strokes):
-        """Write SVG data tree to file """
-
-        tree = et.parse(self.filepath)
-        root = tree.getroot()
+        """Adds the fills to the SVG data tree of the current frame """
         scene = bpy.context.scene
-        name = self._name
-
-        lineset_group = find_svg_elem(tree, ".//svg:g[@id='{}']".format(self._name))
-        if lineset_group is None:
-            lineset_group = et.XML('<g/>')
-            lineset_group.attrib = {
-                'id': name,
-                'xmlns:inkscape': namespaces["inkscape"],
-                'inkscape:groupmode': 'lineset',
-                'inkscape:label': name,
-                }
-            root.append(lineset_group)
-            print('added new lineset group ', name)
-
+        tree = get_svg_tree(self.filepath)
+        lineset_group = get_lineset_group(tree, self._name)
 
         # <g> for the fills of the current frame
-        fill_group = et.XML('<g/>')
-        fill_group.attrib = {
-            'xmlns:inkscape': namespaces["inkscape"],
-            'inkscape:groupmode': 'layer',
-            'inkscape:label': 'fills',
+        fill_group = et.Element(SVG_G, {
+            INKSCAPE_GROUPMODE: 'layer',
+            INKSCAPE_LABEL: 'fills',
             'id': 'fills'
-           }
+            })
 
         fill_elements = self.create_fill_elements(strokes)
         fill_group.extend(reversed(tuple(fill_elements)))
         if scene.svg_export.mode == 'ANIMATION':
             # add the fills to the <g> of the current frame
-            frame_group = find_svg_elem(lineset_group, ".//svg:g[@id='frame_{:04n}']".format(scene.frame_current))
-            frame_group.insert(0, fill_group)
+            get_frame_group(lineset_group, scene.frame_current).insert(0, fill_group)
         else:
             lineset_group.insert(0, fill_group)
 
-        # write SVG to file
-        indent_xml(root)
-        tree.write(self.filepath, encoding='ascii', xml_declaration=True)
-
-
-def stroke_inside_stroke(a, b):
-    box_a = BoundingBox.from_sequence(svert.point for svert in a)
-    box_b = BoundingBox.from_sequence(svert.point for svert in b)
-    return box_a.inside(box_b)
-
 
 def diffuse_from_stroke(stroke, curvemat=CurveMaterialF0D()):
     material = curvemat(Interface0DIterator(stroke))
@@ -604,6 +811,8 @@ class SVGPathShaderCallback(ParameterEditorCallback):
         if not cls.poll(scene, lineset.linestyle):
             return []
         cls.shader.write()
+        # the strokes are in the SVG tree now, don't keep them alive until the next lineset
+        cls.shader = None
 
 
 class SVGFillShaderCallback(ParameterEditorCallback):
@@ -634,33 +843,45 @@ class SVGFillShaderCallback(ParameterEditorCallback):
         bpred = OrBP1D(bpred, AndBP1D(NotBP1D(bpred), AndBP1D(SameShapeIdBP1D(), MaterialBP1D())))
         # chain the edges
         Operators.bidirectional_chain(ChainPredicateIterator(upred, bpred))
-        # export SVG
+        # export SVG, the strokes used for filling are made invisible in the same pass
         collector = StrokeCollector()
-        Operators.create(TrueUP1D(), [collector])
+        Operators.create(TrueUP1D(), [collector, InvisibleStrokeShader()])
 
-        builder = SVGFillBuilder(create_path(scene), render_height(scene), layer.name + '_' + lineset.name)
+        builder = SVGFillBuilder(create_path(scene), render_height(scene), layer.name + '_' + lineset.name,
+                                 scene.svg_export.coord_precision)
         builder.write(collector.strokes)
-        # make strokes used for filling invisible
-        for stroke in collector.strokes:
-            for svert in stroke:
-                svert.attribute.visible = False
 
 
 
 def indent_xml(elem, level=0, indentsize=4):
     """Prettifies XML code (used in SVG exporter) """
-    i = "\n" + level * " " * indentsize
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + " " * indentsize
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent_xml(elem, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    elif level and (not elem.tail or not elem.tail.strip()):
-        elem.tail = i
+    # the stdlib indent (Python 3.9+) gives the same output, except that it leaves the tail of elem alone
+    if hasattr(et, 'indent'):
+        et.indent(elem, " " * indentsize, level)
+        if (len(elem) or level) and (not elem.tail or elem.tail.isspace()):
+            elem.tail = "\n" + level * " " * indentsize
+        return
+
+    # walk the tree with an explicit stack, the indent strings are built once per depth
+    indents = ["\n" + level * " " * indentsize]
+    if (len(elem) or level) and (not elem.tail or elem.tail.isspace()):
+        elem.tail = indents[0]
+    stack = [(elem, 0)]
+    while stack:
+        elem, depth = stack.pop()
+        if not len(elem):
+            continue
+        if len(indents) == depth + 1:
+            indents.append(indents[depth] + " " * indentsize)
+        if not elem.text or elem.text.isspace():
+            elem.text = indents[depth + 1]
+        for child in elem:
+            if not child.tail or child.tail.isspace():
+                child.tail = indents[depth + 1]
+        # the tail of the last child precedes the closing tag of elem
+        if child.tail.isspace():
+            child.tail = indents[depth]
+        stack.extend((child, depth + 1) for child in elem)
 
 
 def register_namespaces(namespaces=namespaces):
@@ -707,7 +928,9 @@ def register():
     bpy.app.handlers.render_init.append(render_init)
     bpy.app.handlers.render_write.append(render_write)
     bpy.app.handlers.render_pre.append(svg_export_header)
+    bpy.app.handlers.render_post.append(svg_export_frame)
     bpy.app.handlers.render_complete.append(svg_export_animation)
+    bpy.app.handlers.render_cancel.append(svg_export_cancel)
 
     # manipulate shaders list
     parameter_editor.callbacks_modifiers_post.append(SVGPathShaderCallback.modifier_post)
@@ -731,7 +954,9 @@ def unregister():
     bpy.app.handlers.render_init.remove(render_init)
     bpy.app.handlers.render_write.remove(render_write)
     bpy.app.handlers.render_pre.remove(svg_export_header)
+    bpy.app.handlers.render_post.remove(svg_export_frame)
     bpy.app.handlers.render_complete.remove(svg_export_animation)
+    bpy.app.handlers.render_cancel.remove(svg_export_cancel)
 
     # manipulate shaders list
     parameter_editor.callbacks_modifiers_post.remove(SVGPathShaderCallback.modifier_post)